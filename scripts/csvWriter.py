@@ -0,0 +1,89 @@
+import os
+import re
+from typing import Any, Iterable
+
+# Rows are collected in memory and written once this many bytes are buffered
+CSV_BUFFER_SIZE = 1 << 20
+HAS_WRITEV = hasattr(os, "writev")  # Not available on Windows
+WRITEV_MAX_BUFFERS = 1024  # IOV_MAX on Linux
+
+# Same quoting as csv.QUOTE_MINIMAL with the default excel dialect
+_needsQuotes = re.compile(r'[",\r\n]').search
+
+def quoteCsvField(value: Any) -> str:
+	if value is None:
+		return ""
+	if not isinstance(value, str):
+		value = str(value)
+	if _needsQuotes(value) is None:
+		return value
+	return '"' + value.replace('"', '""') + '"'
+
+def formatCsvRow(values: Iterable[Any]) -> bytes:
+	return (",".join(map(quoteCsvField, values)) + "\r\n").encode("utf-8")
+
+def _writeParts(file, parts: list[bytes]):
+	# Gather-write the parts with as few syscalls as possible, continuing after partial writes
+	views = [memoryview(part) for part in parts if part]
+	if not HAS_WRITEV:
+		views = [memoryview(b"".join(views))]
+	fd = file.fileno()
+	while views:
+		if HAS_WRITEV:
+			written = os.writev(fd, views[:WRITEV_MAX_BUFFERS])
+		else:
+			written = file.write(views[0])
+		while views and written >= len(views[0]):
+			written -= len(views[0])
+			views.pop(0)
+		if written:
+			views[0] = views[0][written:]
+
+class CsvBytesWriter:
+	"""
+	Drop in replacement for csv.writer that formats rows itself and writes
+	them to an unbuffered binary file in CSV_BUFFER_SIZE batches. Formatted rows
+	are kept as a list and written with one writev call, without joining them first.
+	"""
+	pending: list[bytes]
+	pendingSize: int
+
+	def __init__(self, path: str):
+		self.file = open(path, "wb", buffering=0)
+		self.pending = []
+		self.pendingSize = 0
+
+	def writerow(self, values: Iterable[Any]):
+		self.write(formatCsvRow(values))
+
+	def write(self, rows: bytes):
+		"""Appends rows that were already formatted with formatCsvRow"""
+		self.pending.append(rows)
+		self.pendingSize += len(rows)
+		if self.pendingSize > CSV_BUFFER_SIZE:
+			self.flush()
+
+	def writeRows(self, rows: list[bytes]):
+		"""Appends a list of rows formatted with formatCsvRow"""
+		self.pending.extend(rows)
+		self.pendingSize += sum(map(len, rows))
+		if self.pendingSize > CSV_BUFFER_SIZE:
+			self.flush()
+
+	def flush(self):
+		if self.pending:
+			_writeParts(self.file, self.pending)
+			self.pending = []
+			self.pendingSize = 0
+
+	def close(self):
+		if self.file.closed:
+			return
+		self.flush()
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
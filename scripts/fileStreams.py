@@ -1,79 +1,259 @@
+import contextlib
+import mmap
+import queue
+import threading
 import traceback
-from typing import BinaryIO, Iterator
+from typing import Any, BinaryIO, Callable, Collection, Iterator
 try:
 	import orjson as json
 except ImportError:
 	import json
 	print("Recommended to install 'orjson' for faster JSON parsing")
+try:
+	import msgspec
+except ImportError:
+	msgspec = None
 
 import zstandard
 
 from zst_blocks_format.python_cli.ZstBlocksFile import ZstBlocksFile
 
-def getZstFileJsonStream(f: BinaryIO, chunk_size=1024*1024*10) -> Iterator[dict]:
-	decompressor = zstandard.ZstdDecompressor(max_window_size=2**31)
-	currentString = ""
+# receives bytes or str, raises ValueError on malformed input
+JsonLoads = Callable[[bytes|str], Any]
+
+class ByteCounter:
+	"""How many bytes of the input file a stream has consumed, lets progress logging skip file.tell()"""
+	count: int
+
+	def __init__(self, count: int = 0):
+		self.count = count
+
+	def __call__(self) -> int:
+		return self.count
+
+class _CountingReader:
+	# counts what is read through it, everything except read goes straight to f
+	def __init__(self, f: BinaryIO, byteCounter: ByteCounter):
+		self.f = f
+		self.byteCounter = byteCounter
+
+	def read(self, size: int = -1) -> bytes:
+		data = self.f.read(size)
+		self.byteCounter.count += len(data)
+		return data
+
+	def __getattr__(self, name: str):
+		return getattr(self.f, name)
+
+def getSubredditFilterLoads(acceptSubreddit: Callable[[str], bool], loads: JsonLoads = json.loads) -> JsonLoads:
+	"""
+	Wraps `loads` so that rows whose subreddit is rejected by `acceptSubreddit` decode to None.
+	With msgspec installed only the subreddit field is decoded for rejected rows.
+	"""
+	if msgspec is None:
+		def filterLoads(line):
+			row = loads(line)
+			subreddit = row.get("subreddit") if isinstance(row, dict) else None
+			return row if isinstance(subreddit, str) and acceptSubreddit(subreddit) else None
+		return filterLoads
+
+	class SubredditOnly(msgspec.Struct):
+		subreddit: Any = None
+	decodeSubreddit = msgspec.json.Decoder(SubredditOnly).decode
+	def filterLoads(line):
+		try:
+			subreddit = decodeSubreddit(line).subreddit
+		except msgspec.ValidationError:
+			# valid JSON that isn't an object, same as a missing subreddit in the fallback
+			return None
+		except msgspec.DecodeError as e:
+			raise ValueError(str(e)) from e
+		return loads(line) if isinstance(subreddit, str) and acceptSubreddit(subreddit) else None
+	return filterLoads
+
+def getSubredditPrefilterLoads(subreddits: Collection[str], loads: JsonLoads = json.loads) -> JsonLoads:
+	"""
+	Wraps `loads` so that lines whose raw `"subreddit":"..."` values are all outside of `subreddits`
+	(lowercase names) decode to None without being parsed. Lines where the field isn't found
+	that way (different formatting, unterminated value, str input) are always parsed, so no
+	wanted row is dropped. process_inner.SubredditLineSplitter applies the same rule.
+	"""
+	marker = b'"subreddit":"'
+	wanted = frozenset(subreddit.lower().encode("utf-8") for subreddit in subreddits)
+	def prefilterLoads(line):
+		if isinstance(line, bytes):
+			start = line.find(marker)
+			if start != -1:
+				while start != -1:
+					start += len(marker)
+					end = line.find(b'"', start)
+					if end == -1 or line[start:end].lower() in wanted:
+						return loads(line)
+					start = line.find(marker, end)
+				return None
+		return loads(line)
+	return prefilterLoads
+
+def getFieldsLoads(fields: list[str], loads: JsonLoads = json.loads) -> JsonLoads:
+	"""
+	Returns a loads that only puts `fields` into the row dict, fields missing from a row are left out.
+	With msgspec installed the other fields are skipped without building Python objects for them,
+	otherwise this is just `loads`.
+	"""
+	if msgspec is None:
+		return loads
+
+	FieldsOnly = msgspec.defstruct("FieldsOnly", [(name, Any, msgspec.UNSET) for name in fields])
+	decodeFields = msgspec.json.Decoder(FieldsOnly).decode
+	toBuiltins = msgspec.to_builtins  # leaves out UNSET fields
+	def fieldsLoads(line):
+		try:
+			return toBuiltins(decodeFields(line))
+		except msgspec.DecodeError as e:
+			raise ValueError(str(e)) from e
+	return fieldsLoads
+
+def _loadsLine(line: bytes, loads: JsonLoads):
+	# both orjson and the stdlib accept utf-8 bytes directly, only decode when that fails
+	try:
+		return loads(line)
+	except ValueError:
+		pass
+	return loads(line.decode("utf-8", errors="replace"))
+
+# Upper bound for decompressed chunks waiting in the queue when prefetching
+PREFETCH_BYTES = 1024*1024*32
+
+def _prefetchChunks(read: Callable[[int], bytes], chunkSize: int) -> Iterator[bytes]:
+	"""
+	Calls `read(chunkSize)` on a background thread until it returns b"", so that decompression
+	(zstandard releases the GIL) overlaps with parsing. Exceptions are re-raised in the consumer.
+	The thread stops once the generator is closed, close it before closing the file behind `read`.
+	"""
+	chunks: queue.Queue = queue.Queue(maxsize=max(2, PREFETCH_BYTES // chunkSize))
+	stop = threading.Event()
+	def put(item) -> bool:
+		while not stop.is_set():
+			try:
+				chunks.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				continue
+		return False
+	def produce():
+		try:
+			while not stop.is_set() and put(chunk := read(chunkSize)) and chunk:
+				pass
+		except BaseException as e:
+			put(e)
+	thread = threading.Thread(target=produce, name="zst prefetch", daemon=True)
+	thread.start()
+	try:
+		while True:
+			chunk = chunks.get()
+			if isinstance(chunk, BaseException):
+				raise chunk
+			if not chunk:
+				break
+			yield chunk
+	finally:
+		stop.set()
+		thread.join()
+
+# Splits decompressed bytes into (complete lines, unfinished rest), may leave out lines that aren't wanted
+LineSplitter = Callable[[bytes], tuple[list[bytes], bytes]]
+
+def _splitLines(data: bytes) -> tuple[list[bytes], bytes]:
+	lines = data.split(b"\n")
+	return lines[:-1], lines[-1]
+
+def _readChunks(read: Callable[[int], bytes], chunkSize: int) -> Iterator[bytes]:
+	while chunk := read(chunkSize):
+		yield chunk
+
+def getZstFileJsonStream(f: BinaryIO, chunk_size=1024*1024*10, loads: JsonLoads = json.loads, dict_data: zstandard.ZstdCompressionDict|None = None, prefetch: bool = False, byteCounter: ByteCounter|None = None, splitLines: LineSplitter = _splitLines) -> Iterator[dict]:
+	decompressor = zstandard.ZstdDecompressor(max_window_size=2**31, dict_data=dict_data)
+	# lines are split on raw bytes, so multi-byte characters at chunk borders stay intact and loads gets bytes
+	currentBytes = b""
 	def yieldLinesJson():
-		nonlocal currentString
-		lines = currentString.split("\n")
-		currentString = lines[-1]
-		for line in lines[:-1]:
+		nonlocal currentBytes
+		lines, currentBytes = splitLines(currentBytes)
+		for line in lines:
 			try:
-				yield json.loads(line)
-			except json.JSONDecodeError:
-				print("Error parsing line: " + line)
+				yield _loadsLine(line, loads)
+			except ValueError:
+				print("Error parsing line: " + line.decode("utf-8", errors="replace"))
 				traceback.print_exc()
 				continue
-	zstReader = decompressor.stream_reader(f)
-	while True:
-		try:
-			chunk = zstReader.read(chunk_size)
-		except zstandard.ZstdError:
-			print("Error reading zst chunk")
-			traceback.print_exc()
-			break
-		if not chunk:
-			break
-		currentString += chunk.decode("utf-8", "replace")
-		
-		yield from yieldLinesJson()
+	# files written in several flushes (like organize2.py output) consist of multiple frames
+	# the counter sees compressed bytes, the same unit as the file size
+	zstReader = decompressor.stream_reader(f if byteCounter is None else _CountingReader(f, byteCounter), read_across_frames=True)
+	if prefetch:
+		chunks = _prefetchChunks(zstReader.read, chunk_size)
+	else:
+		chunks = _readChunks(zstReader.read, chunk_size)
+	with contextlib.closing(chunks):
+		while True:
+			try:
+				chunk = next(chunks, b"")
+			except zstandard.ZstdError:
+				print("Error reading zst chunk")
+				traceback.print_exc()
+				break
+			if not chunk:
+				break
+			currentBytes += chunk
+			
+			yield from yieldLinesJson()
 	
 	yield from yieldLinesJson()
 	
-	if len(currentString) > 0:
+	if len(currentBytes) > 0:
 		try:
-			yield json.loads(currentString)
-		except json.JSONDecodeError:
-			print("Error parsing line: " + currentString)
+			yield _loadsLine(currentBytes, loads)
+		except ValueError:
+			print("Error parsing line: " + currentBytes.decode("utf-8", errors="replace"))
 			print(traceback.format_exc())
 			pass
 
-def getJsonLinesFileJsonStream(f: BinaryIO) -> Iterator[dict]:
-	for line in f:
-		line = line.decode("utf-8", errors="replace")
+def _iterLines(f: BinaryIO) -> Iterator[bytes]:
+	if isinstance(f, mmap.mmap):
+		# iterating a mmap yields single bytes, its readline finds line ends with memchr
+		return iter(f.readline, b"")
+	return f
+
+def getJsonLinesFileJsonStream(f: BinaryIO, loads: JsonLoads = json.loads, byteCounter: ByteCounter|None = None) -> Iterator[dict]:
+	for line in _iterLines(f):
+		if byteCounter is not None:
+			byteCounter.count += len(line)
 		try:
-			yield json.loads(line)
-		except json.JSONDecodeError:
-			print("Error parsing line: " + line)
+			yield _loadsLine(line, loads)
+		except ValueError:
+			print("Error parsing line: " + line.decode("utf-8", errors="replace"))
 			traceback.print_exc()
 			continue
 
-def getZstBlocksFileJsonStream(f: BinaryIO) -> Iterator[dict]:
-	for row in ZstBlocksFile.streamRows(f):
-		line = row.decode("utf-8", errors="replace")
+def getZstBlocksFileJsonStream(f: BinaryIO, loads: JsonLoads = json.loads, byteCounter: ByteCounter|None = None) -> Iterator[dict]:
+	for row in ZstBlocksFile.streamRows(f if byteCounter is None else _CountingReader(f, byteCounter)):
 		try:
-			yield json.loads(line)
-		except json.JSONDecodeError:
-			print("Error parsing line: " + line)
+			yield _loadsLine(row, loads)
+		except ValueError:
+			print("Error parsing line: " + row.decode("utf-8", errors="replace"))
 			traceback.print_exc()
 			continue
 
-def getFileJsonStream(path: str, f: BinaryIO) -> Iterator[dict]|None:
+def getFileJsonStream(path: str, f: BinaryIO, loads: JsonLoads = json.loads, dict_data: zstandard.ZstdCompressionDict|None = None, prefetch: bool = False, byteCounter: ByteCounter|None = None, splitLines: LineSplitter|None = None) -> Iterator[dict]|None:
+	"""
+	`prefetch` decompresses .zst files on a background thread that reads from f,
+	close the returned stream (contextlib.closing) before closing f so that the thread stops.
+	`byteCounter` is advanced by the bytes read from f.
+	`splitLines` replaces the line splitting of decompressed .zst chunks, other formats ignore it.
+	"""
 	if path.endswith(".jsonl"):
-		return getJsonLinesFileJsonStream(f)
+		return getJsonLinesFileJsonStream(f, loads, byteCounter)
 	elif path.endswith(".zst"):
-		return getZstFileJsonStream(f)
+		return getZstFileJsonStream(f, loads=loads, dict_data=dict_data, prefetch=prefetch, byteCounter=byteCounter, splitLines=splitLines or _splitLines)
 	elif path.endswith(".zst_blocks"):
-		return getZstBlocksFileJsonStream(f)
+		return getZstBlocksFileJsonStream(f, loads, byteCounter)
 	else:
 		return None
@@ -1,18 +1,21 @@
 import sys
 import csv
 import os
-import orjson as json
-import orjsonl
-import re
-from typing import Dict, List
+import orjson
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+from collections import OrderedDict
 import zstandard as zstd
 import multiprocessing as mp
-from queue import Empty
-from datetime import datetime, UTC
+from queue import Empty, Full
 import pickle
+import functools
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
-from fileStreams import getFileJsonStream
-from utils import FileProgressLog
+from fileStreams import getFileJsonStream, getSubredditFilterLoads
+from utils import FileProgressLog, PROGRESS_ROW_BATCH, scanFiles
 
 # Ensure Python 3.10+
 version = sys.version_info
@@ -37,48 +40,198 @@ def read_whitelist(csv_path):
             if subreddit.startswith('r/'):
                 subreddit = subreddit[2:]
             whitelist.add(subreddit)
-    return whitelist
+    return frozenset(whitelist)
 
 WHITELIST = read_whitelist(DEFAULT_WHITELIST_PATH)
 
 NUM_PROCESSES = mp.cpu_count()  # Use all available CPU cores
+# Open output files kept per writer process, leaving headroom below the OS limit
+MAX_OPEN_FILES = max(1, min(4000, resource.getrlimit(resource.RLIMIT_NOFILE)[0] - 100)) if resource else 400
 
+class SanitizeTable(dict):
+    # str.translate table that keeps word characters and '-' (same as the regex [\w\-]), filled lazily per codepoint
+    def __missing__(self, codepoint: int):
+        char = chr(codepoint)
+        value = codepoint if char.isalnum() or char in "_-" else None
+        self[codepoint] = value
+        return value
+
+SANITIZE_TABLE = SanitizeTable()
+
+@functools.lru_cache(maxsize=200_000)
 def sanitize_subreddit_name(name: str) -> str:
-    sanitized = re.sub(r'[^\w\-]', '', name)
+    sanitized = name.translate(SANITIZE_TABLE)
     return sanitized[:50]
 
+@functools.lru_cache(maxsize=512)
+def month_year_from_days(days: int) -> str:
+    # civil_from_days (Howard Hinnant), pure integer math instead of a datetime per day
+    z = days + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    month = mp + 3 if mp < 10 else mp - 9
+    year = yoe + era * 400 + (month <= 2)
+    return f"{year}-{month:02d}"
+
 def get_month_year(created_utc: int) -> str:
-    date = datetime.fromtimestamp(created_utc, UTC)
-    return date.strftime("%Y-%m")
-
-def write_jsonl_chunk(month_year: str, subreddit: str, data: list):
-    sanitized_subreddit = sanitize_subreddit_name(subreddit)
-    if not sanitized_subreddit:
-        print(f"Skipping problematic subreddit name: {subreddit}")
-        return
-    
-    month_dir = os.path.join(output_dir, month_year)
-    os.makedirs(month_dir, exist_ok=True)
-    output_file = os.path.join(month_dir, f"{sanitized_subreddit}.jsonl")
-    orjsonl.append(output_file, data)
+    # Rows are clustered in time, so nearly every call hits the per-day cache
+    return month_year_from_days(int(created_utc) // 86400)
+
+class PersistentWriter:
+    """
+    Appends chunks to <month>/<subreddit>.jsonl, keeping the most recently used
+    files open instead of reopening them on every chunk.
+    """
+    def __init__(self, directory: str, max_open: int = MAX_OPEN_FILES):
+        self.directory = directory
+        self.max_open = max_open
+        self.handles: OrderedDict[Tuple[str, str], BinaryIO] = OrderedDict()
+        self.created_dirs: set[str] = set()
+
+    def get_handle(self, month_year: str, subreddit: str) -> BinaryIO | None:
+        key = (month_year, subreddit)
+        handle = self.handles.get(key)
+        if handle is not None:
+            self.handles.move_to_end(key)
+            return handle
+
+        sanitized_subreddit = sanitize_subreddit_name(subreddit)
+        if not sanitized_subreddit:
+            print(f"Skipping problematic subreddit name: {subreddit}")
+            return None
+        month_dir = os.path.join(self.directory, month_year)
+        if month_dir not in self.created_dirs:
+            os.makedirs(month_dir, exist_ok=True)
+            self.created_dirs.add(month_dir)
+        output_file = os.path.join(month_dir, f"{sanitized_subreddit}.jsonl")
+
+        if len(self.handles) >= self.max_open:
+            _, oldest = self.handles.popitem(last=False)
+            oldest.close()
+        # Unbuffered, every chunk is a single append and no per-handle buffer is held
+        handle = self.handles[key] = open(output_file, 'ab', buffering=0)
+        return handle
+
+    def write_jsonl_chunk(self, month_year: str, subreddit: str, data: list):
+        handle = self.get_handle(month_year, subreddit)
+        if handle is None:
+            return
+        payload = b''.join(orjson.dumps(item, option=orjson.OPT_APPEND_NEWLINE) for item in data)
+        # Unbuffered writes can be partial, continue until the whole chunk is written
+        view = memoryview(payload)
+        while view:
+            view = view[handle.write(view):]
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+MULTITHREADED_COMPRESSION_SIZE = 64 * 1024 * 1024  # Files above this size are compressed with zstd worker threads
 
 def compress_to_zst(input_file: str, output_file: str):
+    threads = -1 if os.path.getsize(input_file) >= MULTITHREADED_COMPRESSION_SIZE else 0
     with open(input_file, 'rb') as f_in:
-        with open(output_file, 'wb') as f_out:
-            compressor = zstd.ZstdCompressor(level=3)
+        # Append a new frame, an earlier input file may already have written this month and subreddit
+        with open(output_file, 'ab') as f_out:
+            compressor = zstd.ZstdCompressor(level=3, threads=threads)
             compressor.copy_stream(f_in, f_out)
+    os.remove(input_file)  # Remove the original jsonl file after compression
 
-def process_chunk(chunk: Dict[str, Dict[str, list]]):
+def process_chunk(chunk: Dict[str, Dict[str, list]], writer: PersistentWriter):
     for month_year, subreddits in chunk.items():
         for subreddit, data in subreddits.items():
             if data:
-                write_jsonl_chunk(month_year, subreddit, data)
+                writer.write_jsonl_chunk(month_year, subreddit, data)
     chunk.clear()
 
-def process_file(path: str, queue: mp.Queue, start_position: int = 0):
+def _fill_chunk(rows: Iterator[dict], whitelist, get_month_year, chunk: Dict[str, Dict[str, list]], limit: int, on_rows) -> int:
+    """
+    Moves rows from `rows` into chunk[month_year][subreddit] until `limit` rows were
+    added or `rows` is exhausted. None rows (filtered at decode time) are skipped.
+    Returns the number of rows added.
+    Every scanned row is reported through on_rows(count), in batches of PROGRESS_ROW_BATCH.
+    """
+    added = 0
+    scanned = 0
+    # Everything the loop touches is bound to a local first (LOAD_FAST instead of global/attribute lookups)
+    batch_size = PROGRESS_ROW_BATCH
+    chunk_get = chunk.get
+    # An empty whitelist keeps all subreddits
+    in_whitelist = whitelist.__contains__ if whitelist else None
+    for row in rows:
+        scanned += 1
+        if scanned == batch_size:
+            on_rows(scanned)
+            scanned = 0
+        if row is None:
+            continue
+        try:
+            subreddit = row["subreddit"]
+            # Whitelist entries are lowercase, check them before doing any date work
+            if in_whitelist is not None and not in_whitelist(subreddit.lower()):
+                continue
+            month_year = get_month_year(row["created_utc"])
+        except (KeyError, TypeError, AttributeError, ValueError, OverflowError) as e:
+            print(f"Skipping malformed row: {e!r}")
+            continue
+
+        months = chunk_get(month_year)
+        if months is None:
+            months = chunk[month_year] = {}
+        bucket = months.get(subreddit)
+        if bucket is None:
+            bucket = months[subreddit] = []
+        bucket.append(row)
+        added += 1
+        if added >= limit:
+            break
+    on_rows(scanned)
+    return added
+
+try:
+    # Optional compiled row loop, see organize_inner.pyx
+    from organize_inner import fill_chunk
+except ImportError:
+    fill_chunk = _fill_chunk
+
+def partition_chunk(chunk: Dict[str, Dict[str, list]], num_partitions: int) -> List[Dict[str, Dict[str, list]]]:
+    # Partitioned by output file name, case folded for case insensitive file systems, so names that
+    # map to the same file (sanitize_subreddit_name collisions, different casing) share one writer
+    partitions = [{} for _ in range(num_partitions)]
+    for month_year, subreddits in chunk.items():
+        for subreddit, data in subreddits.items():
+            partition = hash(sanitize_subreddit_name(subreddit).lower()) % num_partitions
+            partitions[partition].setdefault(month_year, {})[subreddit] = data
+    return partitions
+
+def put_to_writer(queue: mp.Queue, writer: mp.Process, item):
+    # A writer that died never empties its queue again, raise instead of blocking on it forever
+    while True:
+        try:
+            queue.put(item, timeout=QUEUE_TIMEOUT)
+            return
+        except Full:
+            if not writer.is_alive():
+                raise RuntimeError(f"Writer process {writer.name} exited with code {writer.exitcode}")
+
+def put_chunk(queues: List[mp.Queue], writers: List[mp.Process], chunk: Dict[str, Dict[str, list]]):
+    for queue, writer, partition in zip(queues, writers, partition_chunk(chunk, len(queues))):
+        if partition:
+            put_to_writer(queue, writer, partition)
+
+def in_whitelist(subreddit: str) -> bool:
+    return subreddit.lower() in WHITELIST
+
+# Rows outside the whitelist decode to None without building their dict
+ROW_LOADS = getSubredditFilterLoads(in_whitelist, orjson.loads) if WHITELIST else orjson.loads
+
+def process_file(path: str, queues: List[mp.Queue], writers: List[mp.Process], start_position: int = 0):
        print(f"Processing file {path} from position {start_position}")
        chunk = {}
-       row_count = 0
        file_name = os.path.basename(path)
        if file_name in BLACKLISTED_FILES:
            print(f"Skipping blacklisted file: {file_name}")
@@ -90,46 +243,22 @@ def process_file(path: str, queue: mp.Queue, start_position: int = 0):
                    print(f"Warning: Invalid start position {start_position} for file {path}. Starting from beginning.")
                    start_position = 0
                f.seek(start_position)
-               jsonStream = getFileJsonStream(path, f)
+               jsonStream = getFileJsonStream(path, f, loads=ROW_LOADS)
                if jsonStream is None:
                    print(f"Skipping unknown file {path}")
                    return start_position
                progressLog = FileProgressLog(path, f)
 
-               for row in jsonStream:
-                   try:
-                       progressLog.onRow()
-                       subreddit = row["subreddit"]
-                       created_utc = row["created_utc"]
-                       month_year = get_month_year(created_utc)
-
-                       if WHITELIST and subreddit not in WHITELIST:
-                           continue
-
-                       if month_year not in chunk:
-                           chunk[month_year] = {}
-                       if subreddit not in chunk[month_year]:
-                           chunk[month_year][subreddit] = []
-
-                       chunk[month_year][subreddit].append(row)
-                       row_count += 1
-
-                       if row_count >= CHUNK_SIZE:
-                           queue.put((chunk, path, f.tell()))
-                           chunk = {}
-                           row_count = 0
-                   except zstd.ZstdError as ze:
-                       print(f"Zstd error in file {path} at position {f.tell()}: {ze}")
-                       # Skip to the next 4-byte aligned position
-                       f.seek((f.tell() + 3) & ~3)
-                       continue
-                   except Exception as je:
-                       print(f"JSON decode error in file {path} at position {f.tell()}: {je}")
-                       continue
+               while True:
+                   row_count = fill_chunk(jsonStream, WHITELIST, get_month_year, chunk, CHUNK_SIZE, progressLog.onRows)
+                   if row_count < CHUNK_SIZE:
+                       break
+                   put_chunk(queues, writers, chunk)
+                   chunk = {}
 
                # Process any remaining data
                if chunk:
-                   queue.put((chunk, path, f.tell()))
+                   put_chunk(queues, writers, chunk)
 
                if progressLog.i > 0:
                    progressLog.logProgress("\n")
@@ -141,37 +270,30 @@ def process_file(path: str, queue: mp.Queue, start_position: int = 0):
            print(f"Error processing file {path}: {e}")
            return start_position  # Return the start position if an error occurs
 
-def writer_process(queue: mp.Queue, checkpoint_queue: mp.Queue):
-    while True:
-        try:
-            item = queue.get(timeout=QUEUE_TIMEOUT)
-            if item is None:
+def writer_process(queue: mp.Queue):
+    writer = PersistentWriter(output_dir)
+    failed = False
+    try:
+        while True:
+            try:
+                chunk = queue.get(timeout=QUEUE_TIMEOUT)
+                if chunk is None:
+                    break
+                process_chunk(chunk, writer)
+            except Empty:
+                continue
+            except EOFError:
+                print("Writer process encountered EOFError. Exiting.")
+                failed = True
                 break
-            chunk, file_path, file_position = item
-            process_chunk(chunk)
-            checkpoint_queue.put((file_path, file_position))
-        except Empty:
-            continue
-        except EOFError:
-            print("Writer process encountered EOFError. Exiting.")
-            break
-
-def checkpoint_process(checkpoint_queue: mp.Queue):
-    checkpoint = {}
-    while True:
-        try:
-            item = checkpoint_queue.get(timeout=QUEUE_TIMEOUT)
-            if item is None:
-                break
-            file_path, file_position = item
-            checkpoint[file_path] = file_position
-            with open(CHECKPOINT_FILE, 'wb') as f:
-                pickle.dump(checkpoint, f)
-        except Empty:
-            continue
-        except EOFError:
-            print("Checkpoint process encountered EOFError. Exiting.")
-            break
+            except Exception as e:
+                # Keep draining the queue so the reader never blocks on it, the exit code reports the failure
+                print(f"Writer process failed to write a chunk: {e!r}")
+                failed = True
+    finally:
+        writer.close()
+    if failed:
+        sys.exit(1)
 
 def load_checkpoint():
     if os.path.exists(CHECKPOINT_FILE):
@@ -179,50 +301,65 @@ def load_checkpoint():
             return pickle.load(f)
     return {}
 
-def process_single_file(file: str, start_position: int = 0):
-    with mp.Manager() as manager:
-        queue = manager.Queue(maxsize=10 * NUM_PROCESSES)
-        checkpoint_queue = manager.Queue()
-
-        writers = [mp.Process(target=writer_process, args=(queue, checkpoint_queue)) for _ in range(NUM_PROCESSES)]
-        for writer in writers:
-            writer.start()
+def save_checkpoint(checkpoint: Dict[str, int]):
+    # Write to a temporary file first, so a crash never leaves a truncated checkpoint behind
+    tmp_file = CHECKPOINT_FILE + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(checkpoint, f)
+    os.replace(tmp_file, CHECKPOINT_FILE)
 
-        checkpoint_proc = mp.Process(target=checkpoint_process, args=(checkpoint_queue,))
-        checkpoint_proc.start()
-
-        try:
-            final_position = process_file(file, queue, start_position)
-        except Exception as e:
-            print(f"Error processing file {file}: {e}")
-            final_position = start_position  # Set final_position to start_position if an error occurs
-        finally:
-            # Signal processes to finish
-            for _ in writers:
-                queue.put(None)
-            checkpoint_queue.put(None)
-
-        for writer in writers:
-            writer.join()
-        checkpoint_proc.join()
+def process_single_file(file: str, start_position: int = 0):
+    # One plain mp.Queue per writer (see partition_chunk); a Manager would proxy every chunk through an extra process
+    queues = [mp.Queue(maxsize=10) for _ in range(NUM_PROCESSES)]
+
+    writers = [mp.Process(target=writer_process, args=(queue,)) for queue in queues]
+    for writer in writers:
+        writer.start()
+
+    try:
+        final_position = process_file(file, queues, writers, start_position)
+    except Exception as e:
+        print(f"Error processing file {file}: {e}")
+        final_position = start_position  # Set final_position to start_position if an error occurs
+    finally:
+        # Signal processes to finish
+        for queue, writer in zip(queues, writers):
+            try:
+                put_to_writer(queue, writer, None)
+            except RuntimeError as e:
+                print(e)
+
+    for writer in writers:
+        writer.join()
+    for queue, writer in zip(queues, writers):
+        if writer.exitcode != 0:
+            # Nothing reads this queue any more, exiting shouldn't wait to flush its chunks into the pipe
+            queue.cancel_join_thread()
+    if any(writer.exitcode != 0 for writer in writers):
+        print(f"Writing the output of {file} failed, keeping its checkpoint at {start_position}")
+        final_position = start_position
 
     return final_position
 
+def compress_task(task):
+    compress_to_zst(*task)
+
 def compress_output_files():
     compression_tasks = []
     print("Compressing output files...")
     files_compressed = 0
-    for month_year in os.listdir(output_dir):
-        month_dir = os.path.join(output_dir, month_year)
-        if os.path.isdir(month_dir):
-            for filename in os.listdir(month_dir):
-                if filename.endswith('.jsonl'):
-                    input_file = os.path.join(month_dir, filename)
-                    output_file = os.path.join(month_dir, f"{os.path.splitext(filename)[0]}.zst")
-                    compress_to_zst(input_file, output_file)
-                    os.remove(input_file)  # Remove the original jsonl file after compression
-                    files_compressed += 1
-                    print(f"\rCompressed {files_compressed} files", end='', flush=True)
+    with os.scandir(output_dir) as month_dirs:
+        month_dirs = [entry.path for entry in month_dirs if entry.is_dir()]
+    for month_dir in month_dirs:
+        with os.scandir(month_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.jsonl'):
+                    output_file = os.path.join(month_dir, f"{os.path.splitext(entry.name)[0]}.zst")
+                    compression_tasks.append((entry.path, output_file))
+    with mp.Pool(NUM_PROCESSES) as pool:
+        for _ in pool.imap_unordered(compress_task, compression_tasks, chunksize=16):
+            files_compressed += 1
+            print(f"\rCompressed {files_compressed} files", end='', flush=True)
     print(f"\nCompression complete. Total files compressed: {files_compressed}")
 
 def main():
@@ -231,24 +368,23 @@ def main():
     os.makedirs(output_dir, exist_ok=True)
 
     if os.path.isdir(fileOrFolderPath):
-        files = []
-        if recursive:
-            for root, _, filenames in os.walk(fileOrFolderPath):
-                files.extend(os.path.join(root, filename) for filename in filenames)
-        else:
-            files = [os.path.join(fileOrFolderPath, f) for f in os.listdir(fileOrFolderPath) if os.path.isfile(os.path.join(fileOrFolderPath, f))]
+        files = list(scanFiles(fileOrFolderPath, recursive))
         
         files.sort(reverse=True)
         for file in files:
             if file.endswith('.zst'):
                 start_position = checkpoint.get(file, 0)
                 final_position = process_single_file(file, start_position)
-                checkpoint[file] = final_position
                 compress_output_files()
+                # Checkpoint once per file, after its output is written and compressed
+                checkpoint[file] = final_position
+                save_checkpoint(checkpoint)
     else:
         start_position = checkpoint.get(fileOrFolderPath, 0)
-        process_single_file(fileOrFolderPath, start_position)
+        final_position = process_single_file(fileOrFolderPath, start_position)
         compress_output_files()
+        checkpoint[fileOrFolderPath] = final_position
+        save_checkpoint(checkpoint)
     
     print("Done :>")
 
@@ -2,7 +2,6 @@ import sys
 import csv
 import os
 import orjson
-import re
 from typing import Dict, List
 import zstandard as zstd
 import multiprocessing as mp
@@ -11,11 +10,16 @@ from datetime import datetime, UTC
 import pickle
 import mmap
 import numpy as np
-from collections import defaultdict
-import io
+from collections import defaultdict, OrderedDict
+from itertools import islice
+import functools
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 from fileStreams import getFileJsonStream
-from utils import FileProgressLog
+from utils import FileProgressLog, scanFiles
 
 # Ensure Python 3.10+
 version = sys.version_info
@@ -29,9 +33,17 @@ DEFAULT_WHITELIST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__))
 BLACKLISTED_FILES = {}
 CHUNK_SIZE = 100_000  # Number of rows to process before writing to disk
 CHECKPOINT_FILE = "checkpoint.pkl"
-BUFFER_SIZE = 1024 * 1024  # 1MB buffer for writing
+BUFFER_SIZE = 64 * 1024 * 1024  # 64MB buffer shared by all output files
+HAS_WRITEV = hasattr(os, "writev")  # Not available on Windows
+WRITEV_MAX_BUFFERS = 1024  # IOV_MAX on Linux
+ZSTD_LEVEL = 3
+ZSTD_DICTIONARY_PATH = os.path.join(output_dir, "zstd_dictionary")
+ZSTD_DICTIONARY_SIZE = 64 * 1024
+ZSTD_DICTIONARY_SAMPLES = 100_000  # Number of rows to train the dictionary on
 
 NUM_PROCESSES = mp.cpu_count()  # Use all available CPU cores
+# Open output files kept at once, leaving headroom below the OS limit
+MAX_OPEN_FILES = max(1, min(4000, resource.getrlimit(resource.RLIMIT_NOFILE)[0] - 100)) if resource else 400
 
 def read_whitelist(csv_path):
     whitelist = set()
@@ -42,73 +54,198 @@ def read_whitelist(csv_path):
             if subreddit.startswith('r/'):
                 subreddit = subreddit[2:]
             whitelist.add(subreddit)
-    return whitelist
+    return frozenset(whitelist)
 
 WHITELIST = read_whitelist(DEFAULT_WHITELIST_PATH)
 
-def create_perfect_hash(whitelist):
-    return {item: True for item in whitelist}
+class SanitizeTable(dict):
+    # str.translate table that keeps word characters and '-' (same as the regex [\w\-]), filled lazily per codepoint
+    def __missing__(self, codepoint: int):
+        char = chr(codepoint)
+        value = codepoint if char.isalnum() or char in "_-" else None
+        self[codepoint] = value
+        return value
 
-WHITELIST_HASH = create_perfect_hash(WHITELIST)
+SANITIZE_TABLE = SanitizeTable()
 
+@functools.lru_cache(maxsize=200_000)
 def sanitize_subreddit_name(name: str) -> str:
-    sanitized = re.sub(r'[^\w\-]', '', name)
+    sanitized = name.translate(SANITIZE_TABLE)
     return sanitized[:50]
 
-def get_month_year_vectorized(created_utc_array):
-    dates = np.array(created_utc_array, dtype='datetime64[s]')
-    return np.datetime_as_string(dates, unit='M')
+def get_month_index_vectorized(created_utc_array):
+    # civil_from_days (Howard Hinnant) on whole arrays, returns year * 12 + (month - 1)
+    z = np.asarray(created_utc_array, dtype=np.int64) // 86400 + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    month = np.where(mp < 10, mp + 3, mp - 9)
+    year = yoe + era * 400 + (month <= 2)
+    return year * 12 + (month - 1)
+
+# "YYYY-MM" labels for every month index from 2005 (the first reddit dumps) through 2034
+FIRST_LABEL_MONTH_INDEX = 2005 * 12
+MONTH_LABELS = [f"{i // 12}-{i % 12 + 1:02d}" for i in range(FIRST_LABEL_MONTH_INDEX, 2035 * 12)]
+
+def format_month_index(month_index):
+    offset = month_index - FIRST_LABEL_MONTH_INDEX
+    if 0 <= offset < len(MONTH_LABELS):
+        return MONTH_LABELS[offset]
+    year, month = divmod(month_index, 12)
+    return f"{year}-{month + 1:02d}"
+
+# created_utc values outside of this range can't be converted to np.int64 days
+MAX_CREATED_UTC = 2**62
+
+def whitelisted_created_utc(row):
+    """created_utc of a whitelisted row as an int, None for other subreddits and malformed rows"""
+    try:
+        # Whitelist entries are lowercase
+        if row["subreddit"].lower() not in WHITELIST:
+            return None
+        created_utc = int(row["created_utc"])
+        if not -MAX_CREATED_UTC < created_utc < MAX_CREATED_UTC:
+            raise OverflowError(f"created_utc out of range: {created_utc}")
+        return created_utc
+    except (KeyError, TypeError, AttributeError, ValueError, OverflowError) as e:
+        print(f"Skipping malformed row: {e!r}")
+        return None
 
 def process_batch(batch):
-    subreddits = [row["subreddit"] for row in batch]
-    created_utcs = [row["created_utc"] for row in batch]
-    
-    month_years = get_month_year_vectorized(created_utcs)
-    
-    result = defaultdict(lambda: defaultdict(list))
-    for row, month_year, subreddit in zip(batch, month_years, subreddits):
-        if WHITELIST_HASH.get(subreddit, False):
-            result[month_year][subreddit].append(row)
-    
+    """Returns (month_year, subreddit, jsonl bytes) for every group of whitelisted rows in the batch"""
+    created_utcs = [whitelisted_created_utc(row) for row in batch]
+    kept_list = [i for i, created_utc in enumerate(created_utcs) if created_utc is not None]
+    if not kept_list:
+        return []
+
+    # Columnar layout: serialized rows plus a parallel array of (month, subreddit) group ids
+    dumps = orjson.dumps
+    rows_serialized = [dumps(batch[i], option=orjson.OPT_APPEND_NEWLINE) for i in kept_list]
+    sub_to_id = {}
+    sub_ids = np.fromiter(
+        (sub_to_id.setdefault(batch[i]["subreddit"], len(sub_to_id)) for i in kept_list),
+        dtype=np.int64, count=len(kept_list))
+    sub_names = list(sub_to_id)
+    month_indices = get_month_index_vectorized([created_utcs[i] for i in kept_list])
+    group_ids = month_indices * len(sub_names) + sub_ids
+
+    order = np.argsort(group_ids, kind='stable')
+    sorted_ids = group_ids[order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(sorted_ids)) + 1))
+    ends = np.append(starts[1:], len(sorted_ids))
+
+    order_list = order.tolist()
+    result = []
+    for group_id, start, end in zip(sorted_ids[starts].tolist(), starts.tolist(), ends.tolist()):
+        month_index, sub_id = divmod(group_id, len(sub_names))
+        payload = b''.join([rows_serialized[j] for j in order_list[start:end]])
+        result.append((format_month_index(month_index), sub_names[sub_id], payload))
+
     return result
 
+def load_zstd_dictionary(sample_path: str):
+    if os.path.exists(ZSTD_DICTIONARY_PATH):
+        with open(ZSTD_DICTIONARY_PATH, 'rb') as f:
+            return zstd.ZstdCompressionDict(f.read())
+
+    print(f"Training zstd dictionary on {sample_path}")
+    samples = []
+    with open(sample_path, "rb") as f:
+        jsonStream = getFileJsonStream(sample_path, f, loads=orjson.loads)
+        if jsonStream is None:
+            return None
+        for row in jsonStream:
+            samples.append(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE))
+            if len(samples) >= ZSTD_DICTIONARY_SAMPLES:
+                break
+    try:
+        dict_data = zstd.train_dictionary(ZSTD_DICTIONARY_SIZE, samples, level=ZSTD_LEVEL)
+    except zstd.ZstdError as e:
+        print(f"Could not train zstd dictionary, compressing without one: {e}")
+        return None
+    with open(ZSTD_DICTIONARY_PATH, 'wb') as f:
+        f.write(dict_data.as_bytes())
+    return dict_data
+
+def write_parts(handle, parts):
+    views = [memoryview(part) for part in parts if part]
+    if not HAS_WRITEV:
+        # Unbuffered writes can be partial, continue until all parts are written
+        view = memoryview(b''.join(views))
+        while view:
+            view = view[handle.write(view):]
+        return
+    # Gather-write straight from the compressor output, continuing after partial writes
+    fd = handle.fileno()
+    while views:
+        written = os.writev(fd, views[:WRITEV_MAX_BUFFERS])
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if written:
+            views[0] = views[0][written:]
+
 class BufferedWriter:
-    def __init__(self, directory):
+    """
+    Writes <month>/<subreddit>.zst files. All keys share one buffer of up to
+    BUFFER_SIZE bytes; every flush appends one zstd frame per key, so there is
+    no separate compression pass and reruns can keep appending. Only the
+    max_open most recently used files are kept open.
+    """
+    def __init__(self, directory, dict_data=None, max_open=MAX_OPEN_FILES):
         self.directory = directory
-        self.buffers = defaultdict(io.BytesIO)
-        self.file_handles = {}
+        self.max_open = max_open
+        self.buffer = bytearray()
+        self.offsets = defaultdict(list)  # (month_year, subreddit) -> [(start, end)] in self.buffer
+        self.file_handles = OrderedDict()
+        self.created_dirs = set()
+        self.compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dict_data)
 
     def write(self, month_year, subreddit, data):
-        key = (month_year, subreddit)
-        self.buffers[key].write(data)
-        if self.buffers[key].tell() >= BUFFER_SIZE:
-            self.flush(key)
-
-    def flush(self, key=None):
-        if key is None:
-            keys = list(self.buffers.keys())
-        else:
-            keys = [key]
-        
-        for k in keys:
-            month_year, subreddit = k
-            if k not in self.file_handles:
-                sanitized_subreddit = sanitize_subreddit_name(subreddit)
-                month_dir = os.path.join(self.directory, month_year)
-                os.makedirs(month_dir, exist_ok=True)
-                file_path = os.path.join(month_dir, f"{sanitized_subreddit}.jsonl")
-                self.file_handles[k] = open(file_path, 'ab')
-            
-            self.file_handles[k].write(self.buffers[k].getvalue())
-            self.buffers[k] = io.BytesIO()
+        start = len(self.buffer)
+        self.buffer += data
+        self.offsets[(month_year, subreddit)].append((start, len(self.buffer)))
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.flush()
+
+    def get_handle(self, key):
+        handle = self.file_handles.get(key)
+        if handle is not None:
+            self.file_handles.move_to_end(key)
+            return handle
+
+        month_year, subreddit = key
+        sanitized_subreddit = sanitize_subreddit_name(subreddit)
+        month_dir = os.path.join(self.directory, month_year)
+        if month_dir not in self.created_dirs:
+            os.makedirs(month_dir, exist_ok=True)
+            self.created_dirs.add(month_dir)
+        file_path = os.path.join(month_dir, f"{sanitized_subreddit}.zst")
+
+        if len(self.file_handles) >= self.max_open:
+            _, oldest = self.file_handles.popitem(last=False)
+            oldest.close()
+        # Unbuffered, writes go straight to the fd through write_parts
+        handle = self.file_handles[key] = open(file_path, 'ab', buffering=0)
+        return handle
+
+    def flush(self):
+        with memoryview(self.buffer) as view:
+            for key, ranges in self.offsets.items():
+                compressor = self.compressor.compressobj()
+                parts = [compressor.compress(view[start:end]) for start, end in ranges]
+                parts.append(compressor.flush())
+                write_parts(self.get_handle(key), parts)
+        self.buffer.clear()
+        self.offsets.clear()
 
     def close(self):
         self.flush()
         for handle in self.file_handles.values():
             handle.close()
-
-
-
+        self.file_handles.clear()
 
 def process_file(path: str, writer: BufferedWriter, start_position: int = 0):
     print(f"Processing file {path} from position {start_position}")
@@ -121,42 +258,24 @@ def process_file(path: str, writer: BufferedWriter, start_position: int = 0):
         with open(path, "r+b") as f:
             mmapped_file = mmap.mmap(f.fileno(), 0)
             mmapped_file.seek(start_position)
-            jsonStream = getFileJsonStream(path, mmapped_file)
+            jsonStream = getFileJsonStream(path, mmapped_file, loads=orjson.loads)
             if jsonStream is None:
                 print(f"Skipping unknown file {path}")
                 return start_position
             progressLog = FileProgressLog(path, mmapped_file)
 
-            batch = []
-            for row in jsonStream:
-                try:
-                    progressLog.onRow()
-                    batch.append(row)
-                    
-                    if len(batch) >= CHUNK_SIZE:
-                        result = process_batch(batch)
-                        for month_year, subreddits in result.items():
-                            for subreddit, data in subreddits.items():
-                                writer.write(month_year, subreddit, orjson.dumps(data) + b'\n')
-                        batch = []
-                except zstd.ZstdError as ze:
-                    print(f"Zstd error in file {path} at position {mmapped_file.tell()}: {ze}")
-                    mmapped_file.seek((mmapped_file.tell() + 3) & ~3)
-                    continue
-                except Exception as je:
-                    print(f"JSON decode error in file {path} at position {mmapped_file.tell()}: {je}")
-                    continue
-
-            # Process any remaining data
-            if batch:
-                result = process_batch(batch)
-                for month_year, subreddits in result.items():
-                    for subreddit, data in subreddits.items():
-                        writer.write(month_year, subreddit, orjson.dumps(data) + b'\n')
+            # islice fills each batch in C, there is no per-row Python code left in this loop
+            write = writer.write
+            while True:
+                batch = list(islice(jsonStream, CHUNK_SIZE))
+                if not batch:
+                    break
+                progressLog.onRows(len(batch))
+                for month_year, subreddit, payload in process_batch(batch):
+                    write(month_year, subreddit, payload)
 
             if progressLog.i > 0:
-                progressLog.logProgress(force_print=True)
-                print()  # New line after progress
+                progressLog.logProgress("\n")
             else:
                 print(f"No rows processed in file: {path}")
 
@@ -165,8 +284,8 @@ def process_file(path: str, writer: BufferedWriter, start_position: int = 0):
         print(f"Error processing file {path}: {e}")
         return start_position  # Return the start position if an error occurs
 
-def process_files(files, start_positions):
-    writer = BufferedWriter(output_dir)
+def process_files(files, start_positions, dict_data=None):
+    writer = BufferedWriter(output_dir, dict_data)
     for file, start_position in zip(files, start_positions):
         final_position = process_file(file, writer, start_position)
         yield file, final_position
@@ -184,24 +303,20 @@ def main():
     os.makedirs(output_dir, exist_ok=True)
 
     if os.path.isdir(fileOrFolderPath):
-        files = []
-        if recursive:
-            for root, _, filenames in os.walk(fileOrFolderPath):
-                files.extend(os.path.join(root, filename) for filename in filenames)
-        else:
-            files = [os.path.join(fileOrFolderPath, f) for f in os.listdir(fileOrFolderPath) if os.path.isfile(os.path.join(fileOrFolderPath, f))]
+        files = list(scanFiles(fileOrFolderPath, recursive))
         
         files = [f for f in files if f.endswith('.zst')]
         start_positions = [checkpoint.get(f, 0) for f in files]
+        dict_data = load_zstd_dictionary(files[0]) if files else None
         
-        for file, final_position in process_files(files, start_positions):
+        for file, final_position in process_files(files, start_positions, dict_data):
             checkpoint[file] = final_position
             
         with open(CHECKPOINT_FILE, 'wb') as f:
             pickle.dump(checkpoint, f)
     else:
         start_position = checkpoint.get(fileOrFolderPath, 0)
-        writer = BufferedWriter(output_dir)
+        writer = BufferedWriter(output_dir, load_zstd_dictionary(fileOrFolderPath))
         final_position = process_file(fileOrFolderPath, writer, start_position)
         writer.close()
         checkpoint[fileOrFolderPath] = final_position
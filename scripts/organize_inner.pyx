@@ -0,0 +1,41 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# Compiled version of organize.fill_chunk, build with: cythonize -3 --inplace organize_inner.pyx
+# Keep in sync with the pure Python fallback in organize.py
+from utils import PROGRESS_ROW_BATCH
+
+def fill_chunk(object rows, object whitelist, object get_month_year, dict chunk, Py_ssize_t limit, object on_rows):
+    cdef Py_ssize_t added = 0
+    cdef Py_ssize_t scanned = 0
+    cdef Py_ssize_t batch = PROGRESS_ROW_BATCH
+    cdef dict months
+    cdef list bucket
+    cdef object subreddit, month_year
+    cdef object in_whitelist = whitelist.__contains__ if whitelist else None
+    for row in rows:
+        scanned += 1
+        if scanned == batch:
+            on_rows(scanned)
+            scanned = 0
+        if row is None:
+            continue
+        try:
+            subreddit = row["subreddit"]
+            if in_whitelist is not None and not in_whitelist(subreddit.lower()):
+                continue
+            month_year = get_month_year(row["created_utc"])
+        except (KeyError, TypeError, AttributeError, ValueError, OverflowError) as e:
+            print(f"Skipping malformed row: {e!r}")
+            continue
+
+        months = chunk.get(month_year)
+        if months is None:
+            months = chunk[month_year] = {}
+        bucket = months.get(subreddit)
+        if bucket is None:
+            bucket = months[subreddit] = []
+        bucket.append(row)
+        added += 1
+        if added >= limit:
+            break
+    on_rows(scanned)
+    return added
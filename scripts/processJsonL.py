@@ -1,14 +1,15 @@
 import sys
-import csv
-from datetime import datetime
 version = sys.version_info
 if version.major < 3 or (version.major == 3 and version.minor < 10):
     raise RuntimeError("This script requires Python 3.10 or higher")
 import os
-from typing import Iterable
+import multiprocessing as mp
+from contextlib import closing
+from typing import Iterator, List
 
-from fileStreams import getFileJsonStream
-from utils import FileProgressLog
+from fileStreams import ByteCounter, getFileJsonStream, getFieldsLoads
+from utils import FileProgressLog, PROGRESS_ROW_BATCH, formatTimestamp, scanFiles
+from csvWriter import CsvBytesWriter, formatCsvRow
 
 subreddit = "canadatravel"
 processing_comments = False
@@ -19,67 +20,87 @@ recursive = False
 output_csv_path = f"reddit_{subreddit}_{file_type}.csv"
 
 keywords = ["airtransat", "air transat"]
+keywords_lower = [keyword.lower() for keyword in keywords]
 
-fieldnames = ['post_id', 'post_title', 'post_text', 'post_comment_count', 'post_url', 'post_date', 'poster_username', 'subreddit_name']
+header = ('post_id', 'post_title', 'post_text', 'post_comment_count', 'post_url', 'post_date', 'poster_username', 'subreddit_name')
+NUM_PROCESSES = max(1, (os.cpu_count() or 1) - 1)
+# Only these fields are decoded from each row, see getFieldsLoads
+ROW_LOADS = getFieldsLoads(["id", "title", "url", "permalink", "selftext", "body", "num_comments", "created_utc", "author", "subreddit"])
 
-def processFile(path: str, csv_writer):
+def iterFileRows(path: str) -> Iterator[bytes]:
+    """Yields the formatted csv rows that matched"""
     print(f"Processing file {path}")
     with open(path, "rb") as f:
-        jsonStream = getFileJsonStream(path, f)
+        byte_counter = ByteCounter()
+        jsonStream = getFileJsonStream(path, f, loads=ROW_LOADS, prefetch=True, byteCounter=byte_counter)
         if jsonStream is None:
             print(f"Skipping unknown file {path}")
             return
-        progressLog = FileProgressLog(path, f)
-        for row in jsonStream:
-            progressLog.onRow()
-            
-            
-            # Map the row data to our field names
-            mapped_row = {
-                'post_id': row.get('id', ''),
-                'post_title': row.get('title', ''),
-                'post_url': row.get('url', '') if 'url' in row else row.get('permalink', ''),
-                'post_text': row.get('selftext', '') if 'selftext' in row else row.get('body', ''),
-                'post_comment_count': row.get('num_comments', '0'), 
-                'post_date': datetime.fromtimestamp(row.get('created_utc', 0)).strftime('%Y-%m-%d %H:%M:%S'),
-                'poster_username': row.get('author', ''),
-                'subreddit_name': row.get("subreddit", "")
-
-            }
-            # check if post title or post text contains any of the keywords
-            if any(keyword in mapped_row['post_title'].lower() for keyword in keywords) or any(keyword in mapped_row['post_text'].lower() for keyword in keywords):
-            
-                csv_writer.writerow(mapped_row)
+        progressLog = FileProgressLog(path, f, byte_counter)
+        # Stops the prefetch thread before the file is closed, also when processing fails
+        with closing(jsonStream):
+            rowIndex = 0
+            for rowIndex, row in enumerate(jsonStream, 1):
+                if rowIndex % PROGRESS_ROW_BATCH == 0:
+                    progressLog.onRows(PROGRESS_ROW_BATCH)
 
+                # check if post title or post text contains any of the keywords, lowercasing each text only once
+                post_title = row.get('title', '')
+                post_text = row.get('selftext', '') if 'selftext' in row else row.get('body', '')
+                title_lower = post_title.lower()
+                text_lower = post_text.lower()
+                if not any(keyword in title_lower or keyword in text_lower for keyword in keywords_lower):
+                    continue
+
+                try:
+                    # Every row of the dumps has these
+                    post_id = row['id']
+                    post_date = formatTimestamp(row['created_utc'])
+                    poster_username = row['author']
+                    subreddit_name = row['subreddit']
+                except KeyError:
+                    post_id = row.get('id', '')
+                    post_date = formatTimestamp(row.get('created_utc', 0))
+                    poster_username = row.get('author', '')
+                    subreddit_name = row.get('subreddit', '')
+
+                post_url = row.get('url', '') if 'url' in row else row.get('permalink', '')
+                post_comment_count = row.get('num_comments', '0')
+
+                # Same order as header
+                yield formatCsvRow((post_id, post_title, post_text, post_comment_count, post_url, post_date, poster_username, subreddit_name))
+
+            progressLog.onRows(rowIndex % PROGRESS_ROW_BATCH)
         progressLog.logProgress("\n")
 
+def processFile(path: str) -> List[bytes]:
+    """Runs in a worker process for folders, returns the formatted csv rows that matched"""
+    return list(iterFileRows(path))
+
 def processFolder(path: str, csv_writer):
-    fileIterator: Iterable[str]
-    if recursive:
-        def recursiveFileIterator():
-            for root, dirs, files in os.walk(path):
-                for file in files:
-                    yield os.path.join(root, file)
-        fileIterator = recursiveFileIterator()
-    else:
-        fileIterator = os.listdir(path)
-        fileIterator = (os.path.join(path, file) for file in fileIterator)
+    fileIterator = scanFiles(path, recursive)
     
-    for i, file in enumerate(fileIterator):
-        print(f"Processing file {i+1: 3} {file}")
-        processFile(file, csv_writer)
+    file_list = list(fileIterator)
+    # Workers parse the files in parallel, rows are written in file order
+    with mp.Pool(min(NUM_PROCESSES, len(file_list) or 1)) as pool:
+        for i, (file, csv_rows) in enumerate(zip(file_list, pool.imap(processFile, file_list))):
+            print(f"Processed file {i+1: 3} {file}")
+            csv_writer.writeRows(csv_rows)
 
 def main():
-    with open(output_csv_path, 'w', newline='', encoding='utf-8') as csvfile:
-        csv_writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        csv_writer.writeheader()
+    with CsvBytesWriter(output_csv_path) as csv_writer:
+        csv_writer.writerow(header)
 
         if os.path.isdir(fileOrFolderPath):
             processFolder(fileOrFolderPath, csv_writer)
         else:
-            processFile(fileOrFolderPath, csv_writer)
+            # Without workers the rows are written as they match instead of collecting the whole file
+            with closing(iterFileRows(fileOrFolderPath)) as csv_rows:
+                for csv_row in csv_rows:
+                    csv_writer.write(csv_row)
     
     print(f"Done :> CSV file created at {output_csv_path}")
 
 if __name__ == "__main__":
+    mp.freeze_support()  # This is necessary for Windows support
     main()
@@ -1,10 +1,15 @@
 import sys
-import csv
 import os
-from typing import Iterable, Dict, List, Set, Optional
-from fileStreams import getFileJsonStream
-from utils import FileProgressLog
-from datetime import datetime
+import multiprocessing as mp
+from contextlib import ExitStack, closing
+from collections import defaultdict
+from itertools import islice
+from typing import Dict, FrozenSet, Iterator, List, Optional, Tuple
+import zstandard
+from fileStreams import ByteCounter, getFileJsonStream, getFieldsLoads, getSubredditPrefilterLoads
+from utils import FileProgressLog, formatTimestamp
+from termMatcher import TermMatcher
+from csvWriter import CsvBytesWriter, formatCsvRow
 
 version = sys.version_info
 if version.major < 3 or (version.major == 3 and version.minor < 10):
@@ -14,6 +19,9 @@ if version.major < 3 or (version.major == 3 and version.minor < 10):
 PROCESSING_COMMENTS = False  # Set to False if processing posts
 process_in_reverse = True
 fileOrFolderPath = r"D:\reddit\dumps\reddit\submissions\test"
+# organize2.py stores its zstd dictionary in the root of the organized folder
+organizedRootPath = fileOrFolderPath if os.path.isdir(fileOrFolderPath) else os.path.dirname(os.path.dirname(fileOrFolderPath))
+ZSTD_DICTIONARY_PATH = os.path.join(organizedRootPath, "zstd_dictionary")
 
 # Subreddits and search terms
 subreddits = ["mcdonalds", "askacanadian", "canadaimmigrant", "mcdonaldsemployees"]
@@ -23,94 +31,190 @@ search_terms: Dict[str, Optional[List[str]]] = {
     "canadaimmigrant": ["McDonalds", "McDonald's"],
     "mcdonaldsemployees": None,  # No specific search terms for mcdonaldsemployees
 }
+# One matcher per subreddit scans each row's text once for all of its terms
+term_matchers: Dict[str, TermMatcher] = {
+    subreddit: TermMatcher(terms) for subreddit, terms in search_terms.items() if terms is not None
+}
+
+# Formatted csv rows a worker found in one file, keyed by (subreddit, term)
+Shard = Dict[Tuple[str, Optional[str]], List[bytes]]
+
+HEADER = ('post_id', 'post_title', 'post_text', 'post_comment_count', 'post_url', 'post_date', 'poster_username')
+NUM_PROCESSES = max(1, (os.cpu_count() or 1) - 1)
+# Key names only depend on the configuration, resolve them once
+POST_ID_KEY = "link_id" if PROCESSING_COMMENTS else "id"
+TEXT_KEY = "body" if PROCESSING_COMMENTS else "selftext"
+FILTER_BATCH_SIZE = 4096  # Rows handed to filter_batch at once
+# Only these fields are decoded from each row, see getFieldsLoads
+ROW_FIELDS = ["id", "link_id", "subreddit", "title", "url", "num_comments", "body", "selftext", "created_utc", "author"]
+ROW_LOADS = getFieldsLoads(ROW_FIELDS)
+
+# CSV writers by (subreddit, term), only used by the main process. Rows are deduplicated by id within each
+# organized file (see iter_file_shards), ids are not tracked across files, so don't pass overlapping inputs
+csv_writers: Dict[Tuple[str, Optional[str]], CsvBytesWriter] = {}
+# Every writer is entered on this stack, closing it flushes and closes all csv files
+csv_files = ExitStack()
 
-# CSV writers and processed IDs
-csv_writers: Dict[str, csv.DictWriter] = {}
-processed_ids: Dict[str, Set[str]] = {}
+def load_zstd_dictionary() -> Optional[zstandard.ZstdCompressionDict]:
+    if not os.path.exists(ZSTD_DICTIONARY_PATH):
+        return None
+    with open(ZSTD_DICTIONARY_PATH, 'rb') as f:
+        return zstandard.ZstdCompressionDict(f.read())
+
+ZSTD_DICTIONARY = load_zstd_dictionary()
 
 def create_csv_writer(subreddit: str, term: Optional[str] = None):
     output_csv = f"reddit_{subreddit}_{'comments' if PROCESSING_COMMENTS else 'posts'}{f'_{term.replace(' ', '_')}' if term else ''}.csv"
-    file = open(output_csv, 'w', newline='', encoding='utf-8')
-    fieldnames = ['post_id', 'post_title','post_text', 'post_comment_count', 'post_url', 'post_date', 'poster_username']
-    writer = csv.DictWriter(file, fieldnames=fieldnames)
-    writer.writeheader()  # Write the header
+    writer = csv_files.enter_context(CsvBytesWriter(output_csv))
+    writer.writerow(HEADER)
     return writer
 
-def process_row(row: Dict, subreddit: str, term: Optional[str] = None):
-    csv_key = f"{subreddit}_{term}" if term else subreddit
-    if row['id'] not in processed_ids[csv_key]:
-        post_id = row.get("link_id", "") if PROCESSING_COMMENTS else row.get("id", "")
-        post_title = row.get("title", "")
-        post_url = row.get("url", "")
-        post_comment_count = row.get("num_comments", 0)
-        post_text = row.get("body", "") if PROCESSING_COMMENTS else row.get("selftext", "")
-        post_date = datetime.fromtimestamp(row.get("created_utc", 0)).strftime('%Y-%m-%d %H:%M:%S')
+def process_row(row: Dict) -> bytes:
+    try:
+        # Every row of the dumps has these
+        post_id = row[POST_ID_KEY]
+        post_text = row[TEXT_KEY]
+        post_date = formatTimestamp(row["created_utc"])
+        poster_username = row["author"]
+    except KeyError:
+        post_id = row.get(POST_ID_KEY, "")
+        post_text = row.get(TEXT_KEY, "")
+        post_date = formatTimestamp(row.get("created_utc", 0))
         poster_username = row.get("author", "")
+    # Only posts have these
+    post_title = row.get("title", "")
+    post_url = row.get("url", "")
+    post_comment_count = row.get("num_comments", 0)
+
+    # Same order as HEADER
+    return formatCsvRow((post_id, post_title, post_text, post_comment_count, post_url, post_date, poster_username))
+
+
+def _filter_batch(rows: List[Dict], subreddits: FrozenSet[str], search_terms: Dict[str, Optional[List[str]]], term_matchers: Dict[str, TermMatcher], text_key: str) -> List[Tuple[Dict, str, Optional[List[str]]]]:
+    """Returns (row, subreddit, matched terms) for every row to write, matched terms is None for subreddits without search terms"""
+    matches = []
+    for row in rows:
+        if row is None:
+            # Rejected by the raw subreddit prefilter
+            continue
+        subreddit = row["subreddit"]
+        if not subreddit.islower():
+            # Most dump rows are lowercase already, islower avoids creating a copy for them
+            subreddit = subreddit.lower()
+        if subreddit not in subreddits:
+            continue
+        if search_terms[subreddit] is None:
+            matches.append((row, subreddit, None))
+            continue
+        matched_terms = term_matchers[subreddit].match(row.get(text_key, ""), row.get("title", ""))
+        if matched_terms:
+            matches.append((row, subreddit, matched_terms))
+    return matches
 
-        csv_writers[csv_key].writerow({
-            'post_id': post_id,
-            'post_title': post_title,
-            'post_url': post_url,
-            'post_comment_count': post_comment_count,
-            'post_text': post_text,
-            'post_date': post_date,
-            'poster_username': poster_username
-        })
-        processed_ids[csv_key].add(row['id'])
-
-def process_file(path: str):
+try:
+    # Optional compiled row filter and .zst line splitter, see process_inner.pyx
+    from process_inner import filter_batch, SubredditLineSplitter
+except ImportError:
+    filter_batch = _filter_batch
+    SubredditLineSplitter = None
+
+def iter_file_shards(path: str) -> Iterator[Shard]:
+    """Yields the matching rows of every batch of the file as a separate shard"""
     print(f"Processing file {path}")
+    subreddit_set = frozenset(subreddit.lower() for subreddit in subreddits)
+    # Lines of other subreddits are rejected on their raw bytes, before any JSON decoding
+    loads = getSubredditPrefilterLoads(subreddit_set, ROW_LOADS)
+    # When compiled, .zst chunks are split and prefiltered in one scan that releases the GIL
+    split_lines = SubredditLineSplitter(subreddit_set) if SubredditLineSplitter is not None else None
     with open(path, "rb") as f:
-        jsonStream = getFileJsonStream(path, f)
+        byte_counter = ByteCounter()
+        jsonStream = getFileJsonStream(path, f, loads=loads, prefetch=True, dict_data=ZSTD_DICTIONARY, byteCounter=byte_counter, splitLines=split_lines)
         if jsonStream is None:
             print(f"Skipping unknown file {path}")
             return
-        progressLog = FileProgressLog(path, f)
-        for row in jsonStream:
-            progressLog.onRow()
-            subreddit = row["subreddit"].lower()
-            if subreddit in subreddits:
-                terms = search_terms[subreddit]
-                if terms is None:
-                    # Process all data for subreddits without specific search terms
-                    csv_key = subreddit
-                    if csv_key not in csv_writers:
-                        csv_writers[csv_key] = create_csv_writer(subreddit)
-                        processed_ids[csv_key] = set()
-                    process_row(row, subreddit)
-                else:
-                    text_to_search = row.get("body" if PROCESSING_COMMENTS else "selftext", "").lower()
-                    for term in terms:
-                        if term.lower() in text_to_search or term.lower() in row.get("title", "").lower():
-                            csv_key = f"{subreddit}_{term}"
-                            if csv_key not in csv_writers:
-                                csv_writers[csv_key] = create_csv_writer(subreddit, term)
-                                processed_ids[csv_key] = set()
-                            process_row(row, subreddit, term)
+        progressLog = FileProgressLog(path, f, byte_counter)
+        # organize.py and organize2.py append to existing files, so an interrupted run that was redone
+        # from its checkpoint leaves the same rows in a file twice. Duplicates never span two files
+        # (a row always lands in the file of its month and subreddit), so the ids are tracked per file
+        seen_ids = set()
+        # Stops the prefetch thread before the file is closed, also when processing fails
+        with closing(jsonStream):
+            while True:
+                batch = list(islice(jsonStream, FILTER_BATCH_SIZE))
+                if not batch:
+                    break
+                progressLog.onRows(len(batch))
+                shard: Shard = defaultdict(list)
+                for row, subreddit, matched_terms in filter_batch(batch, subreddit_set, search_terms, term_matchers, TEXT_KEY):
+                    row_id = row.get("id")
+                    if row_id is not None:
+                        if row_id in seen_ids:
+                            continue
+                        seen_ids.add(row_id)
+                    csv_row = process_row(row)
+                    if matched_terms is None:
+                        # Process all data for subreddits without specific search terms
+                        shard[(subreddit, None)].append(csv_row)
+                    else:
+                        for term in matched_terms:
+                            shard[(subreddit, term)].append(csv_row)
+                if shard:
+                    yield shard
         progressLog.logProgress("\n")
 
+def process_file(path: str) -> Shard:
+    """Runs in a worker process, returns the matching rows instead of writing them"""
+    shard: Shard = defaultdict(list)
+    for batch_shard in iter_file_shards(path):
+        for key, rows in batch_shard.items():
+            shard[key].extend(rows)
+    return shard
+
+def get_writer(subreddit: str, term: Optional[str] = None) -> CsvBytesWriter:
+    # Single lookup for writers that already exist, which is every call after the first per key
+    writer = csv_writers.get((subreddit, term))
+    if writer is None:
+        writer = csv_writers[(subreddit, term)] = create_csv_writer(subreddit, term)
+    return writer
+
+def merge_shard(shard: Shard):
+    for (subreddit, term), rows in shard.items():
+        get_writer(subreddit, term).writeRows(rows)
+
+def iter_subreddit_files(path: str) -> Iterator[str]:
+    """Yields the wanted subreddit files month by month, only the month folders are listed up front"""
+    with os.scandir(path) as entries:
+        year_months = sorted((entry for entry in entries if entry.is_dir()), key=lambda entry: entry.name, reverse=process_in_reverse)
+    for year_month in year_months:
+        with os.scandir(year_month.path) as entries:
+            for entry in entries:
+                if os.path.splitext(entry.name)[0].lower() in subreddits:
+                    yield entry.path
+
+def _process_file_with_path(path: str) -> Tuple[str, Shard]:
+    return path, process_file(path)
+
 def process_folder(path: str):
-    for year_month in sorted(os.listdir(path), reverse=process_in_reverse):
-        year_month_path = os.path.join(path, year_month)
-        if os.path.isdir(year_month_path):
-            print(f"Processing folder: {year_month}")
-            for subreddit_file in os.listdir(year_month_path):
-                print(f"Processing file: {subreddit_file}")
-                if subreddit_file.lower().rstrip('.zml') in subreddits:
-                    file_path = os.path.join(year_month_path, subreddit_file)
-                    process_file(file_path)
+    # Files are independent, workers parse them in parallel while the rest of the folder is still listed.
+    # The main process writes the shards in file order, so the csv files come out the same as a serial run
+    with mp.Pool(NUM_PROCESSES) as pool:
+        for file_path, shard in pool.imap(_process_file_with_path, iter_subreddit_files(path)):
+            print(f"Processed file: {file_path}")
+            merge_shard(shard)
 
 def main():
-    if os.path.isdir(fileOrFolderPath):
-        process_folder(fileOrFolderPath)
-    else:
-        process_file(fileOrFolderPath)
-    
-    # Close all CSV files
-    for writer in csv_writers.values():
-        writer.file.close()
+    # Also flushes the rows written so far when processing fails
+    with csv_files:
+        if os.path.isdir(fileOrFolderPath):
+            process_folder(fileOrFolderPath)
+        else:
+            # Without workers the rows are written batch by batch instead of collecting the whole file
+            with closing(iter_file_shards(fileOrFolderPath)) as shards:
+                for shard in shards:
+                    merge_shard(shard)
     
     print("Done :>")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    mp.freeze_support()  # This is necessary for Windows support
+    main()
@@ -0,0 +1,139 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# Compiled versions of the row filtering in processFiles.py / processOrganizedFiles.py, build with: cythonize -3 --inplace process_inner.pyx
+# Keep filter_batch in sync with the pure Python fallbacks in both scripts, and SubredditLineSplitter with getSubredditPrefilterLoads in fileStreams.py
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memchr, memcmp
+
+cdef const char *SUBREDDIT_MARKER = b'"subreddit":"'
+cdef Py_ssize_t SUBREDDIT_MARKER_LENGTH = 13
+
+def filter_batch(list rows, frozenset subreddits, dict search_terms, dict term_matchers, str text_key):
+    cdef list matches = []
+    cdef object row
+    cdef str subreddit
+    cdef list matched_terms
+    for row in rows:
+        if row is None:
+            continue
+        subreddit = row["subreddit"]
+        if not subreddit.islower():
+            # Most dump rows are lowercase already, islower avoids creating a copy for them
+            subreddit = subreddit.lower()
+        if subreddit not in subreddits:
+            continue
+        if search_terms[subreddit] is None:
+            matches.append((row, subreddit, None))
+            continue
+        matched_terms = term_matchers[subreddit].match(row.get(text_key, ""), row.get("title", ""))
+        if matched_terms:
+            matches.append((row, subreddit, matched_terms))
+    return matches
+
+cdef inline char ascii_lower(char c) noexcept nogil:
+    if 65 <= c <= 90:
+        return c + 32
+    return c
+
+cdef const char *find_marker(const char *start, const char *end) noexcept nogil:
+    cdef const char *quote
+    while end - start >= SUBREDDIT_MARKER_LENGTH:
+        quote = <const char *> memchr(start, 34, end - start)
+        if quote == NULL or end - quote < SUBREDDIT_MARKER_LENGTH:
+            return NULL
+        if memcmp(quote, SUBREDDIT_MARKER, SUBREDDIT_MARKER_LENGTH) == 0:
+            return quote
+        start = quote + 1
+    return NULL
+
+cdef class SubredditLineSplitter:
+    """
+    fileStreams.LineSplitter that drops lines whose raw "subreddit":"..." values are all
+    outside of the given names, the same check as getSubredditPrefilterLoads. The scan over
+    a chunk runs without the GIL, so the prefetch thread keeps decompressing meanwhile.
+    """
+    cdef bytes names  # lowercase utf-8 names, concatenated
+    cdef const char *names_data
+    cdef Py_ssize_t *offsets  # start of every name in names, followed by the end of the last one
+    cdef Py_ssize_t count
+
+    def __cinit__(self, subreddits):
+        encoded = [subreddit.lower().encode("utf-8") for subreddit in subreddits]
+        self.count = len(encoded)
+        self.names = b"".join(encoded)
+        self.names_data = self.names
+        self.offsets = <Py_ssize_t *> malloc((self.count + 1) * sizeof(Py_ssize_t))
+        if self.offsets == NULL:
+            raise MemoryError()
+        cdef Py_ssize_t position = 0
+        for i, name in enumerate(encoded):
+            self.offsets[i] = position
+            position += len(name)
+        self.offsets[self.count] = position
+
+    def __dealloc__(self):
+        free(self.offsets)
+
+    cdef bint is_wanted(self, const char *value, Py_ssize_t length) noexcept nogil:
+        cdef Py_ssize_t i, j, start
+        for i in range(self.count):
+            start = self.offsets[i]
+            if self.offsets[i + 1] - start != length:
+                continue
+            for j in range(length):
+                if ascii_lower(value[j]) != self.names_data[start + j]:
+                    break
+            else:
+                return True
+        return False
+
+    cdef bint keep_line(self, const char *line, const char *end) noexcept nogil:
+        cdef const char *marker = find_marker(line, end)
+        cdef const char *value
+        cdef const char *value_end
+        if marker == NULL:
+            # Lines without the field in this exact formatting are left to the parser
+            return True
+        while marker != NULL:
+            value = marker + SUBREDDIT_MARKER_LENGTH
+            value_end = <const char *> memchr(value, 34, end - value)
+            if value_end == NULL:
+                # Unterminated value, also left to the parser
+                return True
+            if self.is_wanted(value, value_end - value):
+                return True
+            marker = find_marker(value_end, end)
+        return False
+
+    def __call__(self, bytes data):
+        cdef const char *start = data
+        cdef const char *end = start + len(data)
+        cdef const char *line = start
+        cdef const char *line_end
+        cdef Py_ssize_t *spans = NULL  # (start, end) offsets of the kept lines
+        cdef Py_ssize_t *grown
+        cdef Py_ssize_t kept = 0, capacity = 0, i
+        cdef bint out_of_memory = False
+        with nogil:
+            while True:
+                line_end = <const char *> memchr(line, 10, end - line)
+                if line_end == NULL:
+                    break
+                if self.keep_line(line, line_end):
+                    if kept == capacity:
+                        capacity = capacity * 2 if capacity else 1024
+                        grown = <Py_ssize_t *> realloc(spans, 2 * capacity * sizeof(Py_ssize_t))
+                        if grown == NULL:
+                            out_of_memory = True
+                            break
+                        spans = grown
+                    spans[2 * kept] = line - start
+                    spans[2 * kept + 1] = line_end - start
+                    kept += 1
+                line = line_end + 1
+        try:
+            if out_of_memory:
+                raise MemoryError()
+            lines = [data[spans[2 * i]:spans[2 * i + 1]] for i in range(kept)]
+        finally:
+            free(spans)
+        return lines, data[line - start:]
@@ -0,0 +1,91 @@
+from typing import Any
+
+try:
+	import hyperscan
+except ImportError:
+	hyperscan = None
+try:
+	import ahocorasick
+except ImportError:
+	ahocorasick = None
+
+# Never part of a search term, keeps matches from spanning two of the scanned texts
+TEXT_SEPARATOR = "\x1f"
+# Below these many distinct words one `in` check per word beats a multi-pattern scan (timed on comment sized texts)
+MIN_HYPERSCAN_WORDS = 5
+MIN_AHOCORASICK_WORDS = 48
+
+class TermMatcher:
+	"""
+	Case insensitive search for several terms at once, a term matches when `term.lower() in text.lower()`.
+	The texts are lowered once and checked with one `in` per word for short term lists. Longer lists
+	are scanned a single time with hyperscan or a pyahocorasick automaton if one of them is installed.
+	"""
+	terms: list[str]
+	words: list[str]
+	termWords: list[int]
+	termPairs: list[tuple[str, str]]
+	allMatched: int
+	database: Any
+	automaton: Any
+	scanMatched: int
+
+	def __init__(self, terms: list[str]):
+		self.terms = terms
+		# Terms that are equal after lowering (like "Canada" and "canada") share one word
+		self.words = list(dict.fromkeys(term.lower() for term in terms))
+		wordIds = {word: wordId for wordId, word in enumerate(self.words)}
+		self.termWords = [wordIds[term.lower()] for term in terms]
+		self.termPairs = [(term, term.lower()) for term in terms]
+		self.allMatched = (1 << len(self.words)) - 1
+		self.database = None
+		self.automaton = None
+		if hyperscan is not None and len(self.words) >= MIN_HYPERSCAN_WORDS:
+			# Hyperscan's caseless mode folds some characters differently than str.lower
+			# (like ß, ς or the Kelvin sign), so it scans lowered text for the lowered words instead
+			self.database = hyperscan.Database()
+			self.database.compile(
+				expressions=[_escapeHyperscanLiteral(word) for word in self.words],
+				ids=list(range(len(self.words))),
+				elements=len(self.words),
+				flags=hyperscan.HS_FLAG_SINGLEMATCH | hyperscan.HS_FLAG_UTF8,
+			)
+			# Bound once here instead of creating a callback on every scan
+			self.onScanMatch = self._onScanMatch
+		elif ahocorasick is not None and len(self.words) >= MIN_AHOCORASICK_WORDS:
+			self.automaton = ahocorasick.Automaton()
+			for wordId, word in enumerate(self.words):
+				self.automaton.add_word(word, wordId)
+			self.automaton.make_automaton()
+
+	def _onScanMatch(self, wordId: int, start: int, end: int, flags: int, context: Any) -> bool:
+		self.scanMatched |= 1 << wordId
+		# Returning True stops the scan, nothing is left to find once every word matched
+		return self.scanMatched == self.allMatched
+
+	def match(self, *texts: str) -> list[str]:
+		"""Returns the terms that occur in any of the texts, in the order they were given"""
+		lowerText = TEXT_SEPARATOR.join(texts).lower()
+		if self.database is not None:
+			self.scanMatched = 0
+			try:
+				self.database.scan(lowerText.encode("utf-8", errors="replace"), match_event_handler=self.onScanMatch)
+			except hyperscan.ScanTerminated:
+				pass
+			matched = self.scanMatched
+		elif self.automaton is not None:
+			matched = 0  # bit per word id
+			allMatched = self.allMatched
+			for _, wordId in self.automaton.iter(lowerText):
+				matched |= 1 << wordId
+				if matched == allMatched:
+					break
+		else:
+			return [term for term, word in self.termPairs if word in lowerText]
+		if matched == 0:
+			return []
+		return [term for term, wordId in zip(self.terms, self.termWords) if matched >> wordId & 1]
+
+def _escapeHyperscanLiteral(term: str) -> bytes:
+	# Hyperscan takes PCRE patterns, escape everything except letters and digits
+	return "".join(c if c.isalnum() else f"\\x{{{ord(c):x}}}" for c in term).encode("utf-8")
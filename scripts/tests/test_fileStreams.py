@@ -0,0 +1,64 @@
+import threading
+from contextlib import closing
+
+import orjson
+import pytest
+import zstandard
+
+import fileStreams
+from fileStreams import getFileJsonStream, getZstFileJsonStream
+
+def prefetchThreads():
+	return [thread for thread in threading.enumerate() if thread.name == "zst prefetch"]
+
+@pytest.fixture
+def zstPath(tmp_path):
+	path = tmp_path / "RC_2020-01.zst"
+	rows = b"".join(orjson.dumps({"id": str(i), "subreddit": "pics"}) + b"\n" for i in range(20_000))
+	path.write_bytes(zstandard.ZstdCompressor().compress(rows))
+	return str(path)
+
+def test_prefetchThreadStopsWhenStreamIsClosedEarly(zstPath, monkeypatch):
+	# Small chunks and queue, so the thread is still waiting to put more when the stream is closed
+	monkeypatch.setattr(fileStreams, "PREFETCH_BYTES", 4096)
+	with open(zstPath, "rb") as f:
+		stream = getZstFileJsonStream(f, chunk_size=1024, loads=orjson.loads, prefetch=True)
+		with closing(stream):
+			assert next(stream) == {"id": "0", "subreddit": "pics"}
+			assert prefetchThreads()
+		assert not prefetchThreads()
+
+def test_prefetchThreadStopsWhenConsumerRaises(zstPath):
+	with pytest.raises(RuntimeError):
+		with open(zstPath, "rb") as f:
+			stream = getFileJsonStream(zstPath, f, loads=orjson.loads, prefetch=True)
+			with closing(stream):
+				for _ in stream:
+					raise RuntimeError()
+	assert not prefetchThreads()
+
+@pytest.fixture(params=["msgspec", "fallback"])
+def filterBackend(request, monkeypatch):
+	if request.param == "msgspec" and fileStreams.msgspec is None:
+		pytest.skip("msgspec is not installed")
+	if request.param == "fallback":
+		monkeypatch.setattr(fileStreams, "msgspec", None)
+
+@pytest.mark.parametrize("line", [
+	b'{"id":"1"}',
+	b'{"id":"1","subreddit":null}',
+	b'{"id":"1","subreddit":5}',
+	b'["pics"]',
+	b'"pics"',
+])
+def test_subredditFilterLoadsRejectsRowsWithoutSubreddit(filterBackend, line, capsys):
+	loads = fileStreams.getSubredditFilterLoads(lambda subreddit: True, orjson.loads)
+	assert fileStreams._loadsLine(line, loads) is None
+	assert capsys.readouterr().out == ""
+
+def test_subredditFilterLoads(filterBackend):
+	loads = fileStreams.getSubredditFilterLoads(lambda subreddit: subreddit.lower() == "pics", orjson.loads)
+	assert loads(b'{"id":"1","subreddit":"Pics"}') == {"id": "1", "subreddit": "Pics"}
+	assert loads(b'{"id":"2","subreddit":"other"}') is None
+	with pytest.raises(ValueError):
+		loads(b'{"id":"3","subreddit":')
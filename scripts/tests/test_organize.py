@@ -0,0 +1,60 @@
+import os
+
+import orjson
+import pytest
+
+import organize
+
+@pytest.fixture
+def jsonlPath(tmp_path, monkeypatch):
+	monkeypatch.setattr(organize, "output_dir", str(tmp_path / "out"))
+	monkeypatch.setattr(organize, "NUM_PROCESSES", 2)
+	monkeypatch.setattr(organize, "CHUNK_SIZE", 10)
+	monkeypatch.setattr(organize, "QUEUE_TIMEOUT", 0.2)
+	subreddits = sorted(organize.WHITELIST)[:20]
+	rows = [{"subreddit": subreddits[i % len(subreddits)], "created_utc": 1500000000 + i, "id": str(i)} for i in range(2000)]
+	path = tmp_path / "RS_2017-07.jsonl"
+	path.write_bytes(b"".join(orjson.dumps(row) + b"\n" for row in rows))
+	return str(path)
+
+def test_writesEveryWhitelistedRow(jsonlPath):
+	assert organize.process_single_file(jsonlPath) == os.path.getsize(jsonlPath)
+	written = 0
+	for month_year in os.listdir(organize.output_dir):
+		for name in os.listdir(os.path.join(organize.output_dir, month_year)):
+			with open(os.path.join(organize.output_dir, month_year, name), "rb") as f:
+				written += sum(1 for _ in f)
+	assert written == 2000
+
+def test_failingWriterKeepsTheCheckpoint(jsonlPath, monkeypatch):
+	def failingWrite(self, month_year, subreddit, data):
+		raise OSError("disk full")
+	monkeypatch.setattr(organize.PersistentWriter, "write_jsonl_chunk", failingWrite)
+	assert organize.process_single_file(jsonlPath, 0) == 0
+
+def test_deadWriterDoesNotBlockTheReader(jsonlPath, monkeypatch):
+	def dyingProcessChunk(chunk, writer):
+		os._exit(1)
+	monkeypatch.setattr(organize, "process_chunk", dyingProcessChunk)
+	assert organize.process_single_file(jsonlPath, 0) == 0
+
+def test_partitionKeepsNamesOfOneFileTogether():
+	chunk = {"2017-07": {"Pics": [1], "pics": [2], "p.i.c.s": [3]}}
+	partitions = [partition for partition in organize.partition_chunk(chunk, 64) if partition]
+	assert len(partitions) == 1
+
+class ShortWriter:
+	"""Accepts at most 7 bytes per write, like a raw file interrupted by a signal"""
+	def __init__(self):
+		self.data = bytearray()
+	def write(self, data):
+		self.data += data[:7]
+		return min(len(data), 7)
+
+def test_writeJsonlChunkRetriesShortWrites(tmp_path, monkeypatch):
+	writer = organize.PersistentWriter(str(tmp_path))
+	handle = ShortWriter()
+	monkeypatch.setattr(writer, "get_handle", lambda month_year, subreddit: handle)
+	rows = [{"id": str(i), "subreddit": "pics"} for i in range(10)]
+	writer.write_jsonl_chunk("2020-01", "pics", rows)
+	assert bytes(handle.data) == b"".join(orjson.dumps(row) + b"\n" for row in rows)
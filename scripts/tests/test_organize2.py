@@ -0,0 +1,48 @@
+import os
+
+import orjson
+import zstandard
+
+import organize2
+
+def readZst(path):
+	with open(path, "rb") as f:
+		return zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True).read()
+
+def test_bufferedWriterKeepsAtMostMaxOpenFiles(tmp_path):
+	writer = organize2.BufferedWriter(str(tmp_path), max_open=2)
+	keys = [("2020-01", f"sub{i}") for i in range(5)]
+	for _ in range(2):
+		for month_year, subreddit in keys:
+			writer.write(month_year, subreddit, f'{{"subreddit":"{subreddit}"}}\n'.encode())
+		writer.flush()
+		assert len(writer.file_handles) <= 2
+	writer.close()
+	for month_year, subreddit in keys:
+		line = f'{{"subreddit":"{subreddit}"}}\n'.encode()
+		assert readZst(os.path.join(tmp_path, month_year, f"{subreddit}.zst")) == line * 2
+
+def test_processBatchSkipsMalformedRows():
+	subreddit = next(iter(organize2.WHITELIST))
+	good = {"subreddit": subreddit, "created_utc": 1500000000, "id": "good"}
+	batch = [
+		{"subreddit": subreddit, "id": "noCreated"},
+		{"subreddit": subreddit, "created_utc": None},
+		{"subreddit": None, "created_utc": 1500000000},
+		{"created_utc": 1500000000},
+		{"subreddit": subreddit, "created_utc": 10**30},
+		["not", "a", "dict"],
+		good,
+	]
+	assert organize2.process_batch(batch) == [("2017-07", subreddit, orjson.dumps(good, option=orjson.OPT_APPEND_NEWLINE))]
+
+def test_writePartsRetriesShortWritesWithoutWritev(monkeypatch):
+	class ShortWriter:
+		data = b""
+		def write(self, data):
+			self.data += bytes(data[:7])
+			return min(len(data), 7)
+	monkeypatch.setattr(organize2, "HAS_WRITEV", False)
+	handle = ShortWriter()
+	organize2.write_parts(handle, [b"first part\n", b"", b"second part\n"])
+	assert handle.data == b"first part\nsecond part\n"
@@ -0,0 +1,17 @@
+import orjson
+import zstandard
+
+import processOrganizedFiles
+
+def writeFrames(path, *frameRows):
+	# One zstd frame per list of rows, like an organize run that appended to an existing file
+	with open(path, "wb") as f:
+		for rows in frameRows:
+			f.write(zstandard.ZstdCompressor().compress(b"".join(orjson.dumps(row) + b"\n" for row in rows)))
+
+def test_rowsAppendedTwiceByARerunAreWrittenOnce(tmp_path):
+	rows = [{"id": str(i), "subreddit": "mcdonaldsemployees", "title": f"post {i}", "created_utc": 1500000000} for i in range(5)]
+	path = str(tmp_path / "mcdonaldsemployees.zst")
+	writeFrames(path, rows[:3], rows, [{"subreddit": "mcdonaldsemployees", "title": "no id", "created_utc": 1500000000}] * 2)
+	shard = processOrganizedFiles.process_file(path)
+	assert len(shard[("mcdonaldsemployees", None)]) == 5 + 2
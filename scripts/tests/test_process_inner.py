@@ -0,0 +1,33 @@
+import pytest
+
+from fileStreams import _splitLines, getSubredditPrefilterLoads
+
+process_inner = pytest.importorskip("process_inner", reason="process_inner.pyx is not compiled")
+
+WANTED = ["AskReddit", "pics", "ünï"]
+LINES = [
+	b'{"id":"1","subreddit":"AskReddit"}',
+	b'{"id":"2","subreddit":"askreddit"}',
+	b'{"id":"3","subreddit":"PICS"}',
+	b'{"id":"4","subreddit":"pic"}',
+	b'{"id":"5","subreddit":"picsx"}',
+	b'{"id":"6","subreddit":""}',
+	'{"id":"7","subreddit":"ünï"}'.encode(),
+	b'{"id":"8","subreddit":"other","parent":{"subreddit":"pics"}}',
+	b'{"id":"9","subreddit":"other","parent":{"subreddit":"other"}}',
+	b'{"id":"10", "subreddit": "other"}',
+	b'{"id":"11","subreddit":"pics',
+	b'{"id":"12","subreddit":"other","parent":{"subreddit":"oth',
+	b'{"id":"13","subreddit":"',
+	b'{"id":"14"}',
+	b'',
+]
+
+def test_lineSplitterMatchesPrefilterLoads():
+	prefilterLoads = getSubredditPrefilterLoads(WANTED, lambda line: line)
+	data = b"\n".join(LINES) + b'\n{"id":"15","subreddit":"oth'
+	lines, rest = _splitLines(data)
+	expected = ([line for line in lines if prefilterLoads(line) is not None], rest)
+	assert process_inner.SubredditLineSplitter(WANTED)(data) == expected
+	# Unterminated values are left to the JSON decoder in both
+	assert b'{"id":"12","subreddit":"other","parent":{"subreddit":"oth' in expected[0]
@@ -0,0 +1,51 @@
+import pytest
+
+import termMatcher
+from termMatcher import TermMatcher
+
+@pytest.fixture(params=["hyperscan", "ahocorasick", "in"])
+def backend(request, monkeypatch):
+	if request.param == "hyperscan" and termMatcher.hyperscan is None:
+		pytest.skip("hyperscan is not installed")
+	if request.param == "ahocorasick" and termMatcher.ahocorasick is None:
+		pytest.skip("pyahocorasick is not installed")
+	if request.param != "hyperscan":
+		monkeypatch.setattr(termMatcher, "hyperscan", None)
+	if request.param == "in":
+		monkeypatch.setattr(termMatcher, "ahocorasick", None)
+	# Scan even the short term lists used here
+	monkeypatch.setattr(termMatcher, "MIN_HYPERSCAN_WORDS", 1)
+	monkeypatch.setattr(termMatcher, "MIN_AHOCORASICK_WORDS", 1)
+
+def expectedMatches(terms, *texts):
+	return [term for term in terms if any(term.lower() in text.lower() for text in texts)]
+
+def test_matchesInTermOrder(backend):
+	matcher = TermMatcher(["maple", "Toronto", "moose"])
+	assert matcher.match("I saw a MOOSE", "Trip to toronto") == ["Toronto", "moose"]
+	assert matcher.match("nothing here", "") == []
+
+def test_caseDuplicateTermsAllMatch(backend):
+	assert TermMatcher(["Canada", "canada"]).match("canada day", "") == ["Canada", "canada"]
+	assert TermMatcher(["A", "a"]).match("", "A title") == ["A", "a"]
+
+def test_noMatchAcrossTexts(backend):
+	assert TermMatcher(["ab"]).match("a", "b") == []
+
+@pytest.mark.parametrize("terms, text", [
+	(["ς", "σ", "Σ"], "ΟΔΟΣ"),
+	(["ss", "ß"], "Straße"),
+	(["i", "ı"], "İstanbul"),
+	(["k"], "5 K"),
+])
+def test_sameFoldingAsStrLower(backend, terms, text):
+	assert TermMatcher(terms).match(text, "") == expectedMatches(terms, text, "")
+
+def test_scanStopsOnceEveryWordMatched(backend):
+	matcher = TermMatcher(["maple", "Maple", "moose"])
+	assert matcher.match("maple moose " * 1000, "moose") == ["maple", "Maple", "moose"]
+
+def test_shortTermListsSkipTheScanners():
+	matcher = TermMatcher(["Canada", "Canadian"])
+	assert matcher.database is None and matcher.automaton is None
+	assert matcher.match("Air Canada", "") == ["Canada"]
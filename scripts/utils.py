@@ -1,19 +1,26 @@
 import sys
 import os
 import time
-from typing import BinaryIO
+import functools
+import math
+from typing import BinaryIO, Callable, Iterator
 
+# Hot loops report rows to FileProgressLog.onRows in batches of this size instead of calling onRow per row
+PROGRESS_ROW_BATCH = 1024
 
 class FileProgressLog:
 	file: BinaryIO
+	byteSource: Callable[[], int]
 	fileSize: int
 	i: int
 	startTime: float
 	printEvery: int
 	maxLineLength: int
 
-	def __init__(self, path: str, file: BinaryIO):
+	def __init__(self, path: str, file: BinaryIO, byteSource: Callable[[], int]|None = None):
+		"""`byteSource` returns how much of the file was read so far (like a fileStreams.ByteCounter), defaults to file.tell"""
 		self.file = file
+		self.byteSource = byteSource or file.tell
 		self.fileSize = os.path.getsize(path)
 		self.i = 0
 		self.startTime = time.time()
@@ -24,12 +31,18 @@ class FileProgressLog:
 		self.i += 1
 		if self.i % self.printEvery == 0 and self.i > 0:
 			self.logProgress()
+
+	def onRows(self, count: int):
+		previous = self.i
+		self.i += count
+		if self.i // self.printEvery != previous // self.printEvery:
+			self.logProgress()
 		
 	def logProgress(self, end=""):
-		progress = self.file.tell() / self.fileSize if not self.file.closed else 1
+		progress = self.byteSource() / self.fileSize if not self.file.closed else 1
 		elapsed = time.time() - self.startTime
 		remaining = (elapsed / progress - elapsed) if progress > 0 else 0
-		timePerRow = elapsed / self.i
+		timePerRow = elapsed / self.i if self.i > 0 else 0
 		printStr = f"{self.i:,} - {progress:.2%} - elapsed: {formatTime(elapsed)} - remaining: {formatTime(remaining)} - {formatTime(timePerRow)}/row"
 		self.maxLineLength = max(self.maxLineLength, len(printStr))
 		printStr = printStr.ljust(self.maxLineLength)
@@ -42,6 +55,18 @@ class FileProgressLog:
 		else:
 			self.printEvery = 5_000
 
+def scanFiles(path: str, recursive: bool = False) -> Iterator[str]:
+	"""Paths of the files in a folder, os.scandir reports the entry types without a stat call per entry"""
+	subfolders = []
+	with os.scandir(path) as entries:
+		for entry in entries:
+			if entry.is_file():
+				yield entry.path
+			elif recursive and entry.is_dir(follow_symlinks=False):
+				subfolders.append(entry.path)
+	for subfolder in subfolders:
+		yield from scanFiles(subfolder, True)
+
 def formatTime(seconds: float) -> str:
 	if seconds == 0:
 		return "0s"
@@ -54,6 +79,29 @@ def formatTime(seconds: float) -> str:
 	elapsedSec = int(seconds % 60)
 	return f"{elapsedHr:02}:{elapsedMin:02}:{elapsedSec:02}"
 
+@functools.lru_cache(maxsize=4096)
+def _localQuarterHour(quarterHour: int) -> tuple[str, int]|None:
+	# Local date and hour are usually the same for a whole UTC quarter hour (offsets are multiples of
+	# 15 minutes), then only minutes and seconds need formatting. None if the offset changes inside it
+	start = time.localtime(quarterHour * 900)
+	end = time.localtime(quarterHour * 900 + 899)
+	if start.tm_gmtoff != end.tm_gmtoff or start.tm_sec != 0 or start.tm_min % 15 != 0:
+		return None
+	return f"{start.tm_year:04d}-{start.tm_mon:02d}-{start.tm_mday:02d} {start.tm_hour:02d}:", start.tm_min
+
+def formatTimestamp(timestamp: int|float|str) -> str:
+	"""Same as datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S'), without the datetime"""
+	if isinstance(timestamp, float):
+		# datetime rounds to whole microseconds before dropping them
+		timestamp = math.floor(round(timestamp, 6))
+	else:
+		timestamp = int(timestamp)
+	quarterHour, seconds = divmod(timestamp, 900)
+	cached = _localQuarterHour(quarterHour)
+	if cached is None:
+		return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+	prefix, minute = cached
+	return f"{prefix}{minute + seconds // 60:02d}:{seconds % 60:02d}"
 
 import psutil
 from datetime import timedelta